@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
@@ -6,9 +7,10 @@ from botbuilder.core import BotFrameworkAdapterSettings, BotFrameworkAdapter, Tu
 from botbuilder.schema import Activity
 from botframework.connector.auth import MicrosoftAppCredentials
 
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.core.credentials import AzureKeyCredential
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,6 +19,7 @@ load_dotenv()
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "kb-index")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))
 
 MICROSOFT_APP_ID = os.getenv("MicrosoftAppId", "")
 MICROSOFT_APP_PASSWORD = os.getenv("MicrosoftAppPassword", "")
@@ -42,6 +45,9 @@ search_client = SearchClient(
     credential=AzureKeyCredential(AZURE_SEARCH_KEY),
 )
 
+# Repeated questions skip the search round trip; TTL bounds staleness after re-ingest
+search_cache = TTLCache(maxsize=1024, ttl=SEARCH_CACHE_TTL)
+
 # ============ Bot Adapter ============
 if MICROSOFT_APP_TENANT_ID:
     MicrosoftAppCredentials.tenant_id = MICROSOFT_APP_TENANT_ID
@@ -50,11 +56,24 @@ settings = BotFrameworkAdapterSettings(MICROSOFT_APP_ID, MICROSOFT_APP_PASSWORD)
 adapter = BotFrameworkAdapter(settings)
 
 # ============ FastAPI ============
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await search_client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # ============ Helpers ============
-def search_top_k(question: str, k: int = 5):
-    results = search_client.search(
+def normalize_question(question: str):
+    return " ".join(question.lower().split())
+
+async def search_top_k(question: str, k: int = 5):
+    cache_key = (normalize_question(question), k)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    results = await search_client.search(
         search_text=question,
         select=["content", "source_type", "source", "page"],
         top=k
@@ -62,7 +81,7 @@ def search_top_k(question: str, k: int = 5):
 
     contexts = []
     sources = []
-    for r in results:
+    async for r in results:
         contexts.append(r.get("content", ""))
         sources.append({
             "source_type": r.get("source_type"),
@@ -70,15 +89,16 @@ def search_top_k(question: str, k: int = 5):
             "page": r.get("page", 0)
         })
 
+    search_cache[cache_key] = (contexts, sources)
     return contexts, sources
 
 def format_answer(contexts, sources):
     if not contexts:
         return "Not available in uploaded Excel/PDF data."
 
-    answer = "✅ I found these relevant details in KB:\n\n"
+    parts = ["✅ I found these relevant details in KB:", ""]
     for i, c in enumerate(contexts[:3], start=1):
-        answer += f"{i}) {c}\n\n"
+        parts.extend((f"{i}) {c}", ""))
 
     src_lines = []
     for s in sources[:3]:
@@ -88,9 +108,10 @@ def format_answer(contexts, sources):
             src_lines.append(f"- {s.get('source')} (excel)")
 
     if src_lines:
-        answer += "📌 Sources:\n" + "\n".join(src_lines)
+        parts.append("📌 Sources:")
+        parts.extend(src_lines)
 
-    return answer
+    return "\n".join(parts)
 
 async def on_message_activity(turn_context: TurnContext):
     question = (turn_context.activity.text or "").strip()
@@ -99,7 +120,7 @@ async def on_message_activity(turn_context: TurnContext):
         return
 
     try:
-        contexts, sources = search_top_k(question, k=5)
+        contexts, sources = await search_top_k(question, k=5)
         answer = format_answer(contexts, sources)
     except Exception as e:
         answer = f"⚠️ Error: {str(e)}"
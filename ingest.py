@@ -1,14 +1,28 @@
 import os
-import io
+import functools
+import hashlib
+import importlib.util
+import json
+import sqlite3
+import tempfile
+import threading
 import uuid
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import BinaryIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from azure.storage.blob import BlobServiceClient
 from azure.search.documents import SearchClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 
-from PyPDF2 import PdfReader
+import pypdfium2 as pdfium
 from sentence_transformers import SentenceTransformer
 
 # ========= ENV =========
@@ -18,62 +32,243 @@ BLOB_CONTAINER = os.getenv("BLOB_CONTAINER", "kb-files")
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "kb-index")
+# "int8" for indexes whose contentVector is Collection(Edm.SByte) with vectorEncoding int8
+VECTOR_ENCODING = os.getenv("VECTOR_ENCODING", "float32")
+# Float vectors are sent rounded to this many decimals; float32 -> Python float repr is ~19 chars
+VECTOR_DECIMALS = 6
 
 VECTOR_DIM = 384  # MiniLM
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# Intra-op threads for embedding inference; 0 keeps the runtime default (one per physical core).
+# Set it to the container's CPU quota when the host reports more cores than the app may use.
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+# "onnx", "openvino", or "auto" (OpenVINO on Intel CPUs when installed, ONNX otherwise)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "auto")
+# SQLite file caching chunk embeddings across ingest runs; empty disables the cache
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "")
+
+# Azure Search accepts at most 1000 docs / 16 MB per indexing request
+UPLOAD_MAX_BATCH = 1000
+UPLOAD_MAX_BYTES = 16 * 1024 * 1024
+UPLOAD_WORKERS = 8
+UPLOAD_RETRIES = 6
+DOWNLOAD_WORKERS = 16
+# Blobs larger than this spill from memory to a temp file while downloading
+DOWNLOAD_SPOOL_BYTES = 32 * 1024 * 1024
+
+def _is_intel_cpu():
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "GenuineIntel" in f.read(4096)
+    except OSError:
+        return False
+
+def _embed_backend():
+    if EMBED_BACKEND != "auto":
+        return EMBED_BACKEND
+    if _is_intel_cpu() and _has_openvino_backend():
+        return "openvino"
+    return "onnx"
+
+def _has_openvino_backend():
+    # Sentence Transformers' OpenVINO backend needs optimum-intel, not just openvino.
+    # Check the parent first: find_spec("optimum.intel") raises if optimum is missing.
+    return (
+        importlib.util.find_spec("openvino") is not None
+        and importlib.util.find_spec("optimum") is not None
+        and importlib.util.find_spec("optimum.intel") is not None
+    )
+
+def _embedder_model_kwargs(backend: str):
+    if backend == "openvino":
+        kwargs = {"file_name": "openvino/openvino_model_qint8_quantized.xml"}
+        if EMBED_THREADS:
+            kwargs["ov_config"] = {"INFERENCE_NUM_THREADS": EMBED_THREADS}
+        return kwargs
 
-# Load embedding model once
-embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    kwargs = {"file_name": "onnx/model_qint8_avx512_vnni.onnx"}
+    if EMBED_THREADS:
+        import onnxruntime as ort
+
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = EMBED_THREADS
+        session_options.inter_op_num_threads = 1
+        kwargs["session_options"] = session_options
+    return kwargs
+
+# Load embedding model once (int8 weights published in the model repo)
+_backend = _embed_backend()
+if _backend not in ("onnx", "openvino"):
+    raise ValueError(f"Unsupported EMBED_BACKEND: {_backend}")
+_model_kwargs = _embedder_model_kwargs(_backend)
+embedder = SentenceTransformer(EMBED_MODEL, backend=_backend, model_kwargs=_model_kwargs)
+# Cache entries are only valid for the exact weights that produced them
+_embed_model_id = f"{EMBED_MODEL}:{_model_kwargs['file_name']}"
+
+_pdfium_lock = threading.Lock()
+_embed_cache_lock = threading.Lock()
+
+def _pooled_transport(pool_size: int):
+    # requests keeps only 10 connections per host by default; size the pool to the worker count
+    # so concurrent calls reuse warm TLS connections. urllib3 retries stay off as in azure-core.
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session)
 
 search_client = SearchClient(
     endpoint=AZURE_SEARCH_ENDPOINT,
     index_name=AZURE_SEARCH_INDEX,
     credential=AzureKeyCredential(AZURE_SEARCH_KEY),
+    transport=_pooled_transport(UPLOAD_WORKERS),
+    # azure-core retries 429/503 and honors Retry-After; give concurrent uploads more room
+    retry_total=UPLOAD_RETRIES,
 )
 
-def get_embedding(text: str):
+@functools.lru_cache(maxsize=1)
+def get_container_client():
+    # Created on first ingest and reused so later runs keep the warm connection pool
+    blob_service = BlobServiceClient.from_connection_string(
+        AZURE_STORAGE_CONNECTION_STRING,
+        transport=_pooled_transport(DOWNLOAD_WORKERS),
+    )
+    return blob_service.get_container_client(BLOB_CONTAINER)
+
+def _clean_text(text: str):
     text = (text or "").replace("\n", " ").strip()
-    if not text:
-        text = "empty"
-    return embedder.encode([text])[0].tolist()
+    return text or "empty"
+
+def get_embedding(text: str):
+    return embedder.encode([_clean_text(text)])[0].tolist()
+
+def get_embeddings(texts, batch_size: int = 64):
+    if not texts:
+        return np.empty((0, VECTOR_DIM), dtype=np.float32)
+    cleaned = [_clean_text(t) for t in texts]
+    # Headers and boilerplate repeat across chunks; encode each distinct text once
+    unique = list(dict.fromkeys(cleaned))
+    if EMBED_CACHE_PATH:
+        embs = _encode_with_cache(unique, batch_size)
+    else:
+        embs = _encode(unique, batch_size)
+    if len(unique) == len(cleaned):
+        return embs
+    row_of = {t: i for i, t in enumerate(unique)}
+    return embs[[row_of[t] for t in cleaned]]
+
+def _encode(texts, batch_size: int):
+    # encode() sorts inputs by length before batching and restores the order, so
+    # Excel rows and long PDF chunks are not padded together; no pre-sort needed here
+    return embedder.encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+    )
+
+@functools.lru_cache(maxsize=1)
+def _embed_cache():
+    conn = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+    return conn
+
+def _cache_key(text: str):
+    return hashlib.blake2b(f"{_embed_model_id}:{text}".encode(), digest_size=16).digest()
+
+def _encode_with_cache(texts, batch_size: int):
+    keys = [_cache_key(t) for t in texts]
+    conn = _embed_cache()
+
+    cached = {}
+    with _embed_cache_lock:
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cached.update(conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", chunk
+            ))
+
+    embs = np.empty((len(texts), VECTOR_DIM), dtype=np.float32)
+    misses = []
+    for i, key in enumerate(keys):
+        vec = cached.get(key)
+        if vec is None:
+            misses.append(i)
+        else:
+            embs[i] = np.frombuffer(vec, dtype=np.float32)
+
+    if misses:
+        fresh = _encode([texts[i] for i in misses], batch_size).astype(np.float32)
+        embs[misses] = fresh
+        with _embed_cache_lock:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                ((keys[i], fresh[j].tobytes()) for j, i in enumerate(misses)),
+            )
+            conn.commit()
+    return embs
+
+def quantize_int8(embs: np.ndarray):
+    # Per-vector scaling keeps the full int8 range; cosine similarity is scale-invariant
+    max_abs = np.abs(embs).max(axis=1, keepdims=True)
+    scale = 127.0 / np.maximum(max_abs, 1e-12)
+    return np.clip(np.round(embs * scale), -127, 127).astype(np.int8)
+
+def to_vector_field(embs: np.ndarray):
+    if VECTOR_ENCODING == "int8":
+        return quantize_int8(embs).tolist()
+    # Round in float64 so the shortest repr is e.g. 0.034568 rather than 0.03456789255142212
+    return np.round(embs.astype(np.float64), VECTOR_DECIMALS).tolist()
 
 def chunk_text(text: str, max_chars: int = 1000, overlap: int = 150):
     text = (text or "").strip()
     if not text:
         return []
-    chunks = []
-    start = 0
     n = len(text)
-    while start < n:
-        end = min(n, start + max_chars)
-        chunks.append(text[start:end])
-        start = end - overlap
-        if start < 0:
-            start = 0
-        if start >= n:
-            break
-    return chunks
-
-def normalize(v):
-    return "" if v is None else str(v).strip()
-
-def extract_from_excel(file_bytes: bytes, filename: str):
-    df = pd.read_excel(io.BytesIO(file_bytes))
-    docs = []
-    for _, row in df.iterrows():
-        row_text = " | ".join([f"{c}:{normalize(row[c])}" for c in df.columns])
-        docs.append({
-            "source_type": "excel",
-            "source_file": filename,
-            "page": 0,
-            "content": row_text
-        })
-    return docs
+    step = max(1, max_chars - overlap)
+    # Stop once a chunk reaches the end so no trailing chunk is just overlap
+    return [text[s:s + max_chars] for s in range(0, max(1, n - overlap), step)]
+
+def extract_from_excel(stream: BinaryIO, filename: str):
+    df = pd.read_excel(stream)
+    if df.empty:
+        return []
+
+    # Column-wise string ops instead of iterrows: every missing cell (NaN, None, NaT) becomes "".
+    # Going through object dtype keeps str(value) formatting, e.g. "2024-01-01 00:00:00" for dates.
+    sdf = df.astype(object).where(df.notna(), "").astype(str).apply(lambda s: s.str.strip())
+    # One format() per row over per-column lists, so no "col:value" string is built per cell
+    template = " | ".join(str(c).replace("{", "{{").replace("}", "}}") + ":{}" for c in sdf.columns)
+    row_texts = list(map(template.format, *(sdf[c].tolist() for c in sdf.columns)))
+
+    return [{
+        "source_type": "excel",
+        "source_file": filename,
+        "page": 0,
+        "content": row_text
+    } for row_text in row_texts]
+
+def extract_from_pdf(stream: BinaryIO, filename: str):
+    # PDFium is not thread-safe and blobs are extracted on a thread pool
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(stream)
+        page_texts = []
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                page_texts.append(textpage.get_text_range() or "")
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
 
-def extract_from_pdf(file_bytes: bytes, filename: str):
-    reader = PdfReader(io.BytesIO(file_bytes))
     docs = []
-    for page_no, page in enumerate(reader.pages, start=1):
-        text = page.extract_text() or ""
+    for page_no, text in enumerate(page_texts, start=1):
         for chunk in chunk_text(text):
             docs.append({
                 "source_type": "pdf",
@@ -83,44 +278,77 @@ def extract_from_pdf(file_bytes: bytes, filename: str):
             })
     return docs
 
+def new_doc_ids(n: int):
+    # One urandom read for all ids instead of one per uuid4() call
+    raw = os.urandom(16 * n)
+    return [str(uuid.UUID(bytes=raw[i:i + 16], version=4)) for i in range(0, 16 * n, 16)]
+
+def _download_and_extract(container_client, blob_name: str):
+    lower = blob_name.lower()
+    if lower.endswith(".xlsx") or lower.endswith(".xls"):
+        extract = extract_from_excel
+    elif lower.endswith(".pdf"):
+        extract = extract_from_pdf
+    else:
+        return []
+
+    blob_client = container_client.get_blob_client(blob_name)
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES) as stream:
+        blob_client.download_blob().readinto(stream)
+        stream.seek(0)
+        return extract(stream, blob_name)
+
+def _upload_batch_size(search_docs, default: int = 200):
+    # Grow batches toward the payload cap, keeping 25% headroom for JSON overhead
+    sample = search_docs[:50]
+    if not sample:
+        return default
+    avg_bytes = len(json.dumps(sample)) / len(sample)
+    fit = int(UPLOAD_MAX_BYTES * 0.75 / avg_bytes)
+    return max(default, min(UPLOAD_MAX_BATCH, fit))
+
+def upload_search_docs(search_docs):
+    batch_size = _upload_batch_size(search_docs)
+    batches = [search_docs[i:i + batch_size] for i in range(0, len(search_docs), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as ex:
+        futures = [
+            ex.submit(search_client.upload_documents, documents=batch)
+            for batch in batches
+        ]
+        results = [f.result() for f in futures]
+
+    return sum(1 for batch_results in results for r in batch_results if r.succeeded)
+
 def ingest_all_blobs():
     if not AZURE_STORAGE_CONNECTION_STRING:
         raise ValueError("AZURE_STORAGE_CONNECTION_STRING missing")
     if not (AZURE_SEARCH_ENDPOINT and AZURE_SEARCH_KEY and AZURE_SEARCH_INDEX):
         raise ValueError("Azure Search env vars missing")
+    if VECTOR_ENCODING not in ("float32", "int8"):
+        raise ValueError(f"Unsupported VECTOR_ENCODING: {VECTOR_ENCODING}")
 
-    blob_service = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-    container_client = blob_service.get_container_client(BLOB_CONTAINER)
+    container_client = get_container_client()
+    blob_names = [blob.name for blob in container_client.list_blobs()]
 
     extracted_docs = []
-    for blob in container_client.list_blobs():
-        blob_name = blob.name
-        lower = blob_name.lower()
-
-        blob_client = container_client.get_blob_client(blob_name)
-        data = blob_client.download_blob().readall()
-
-        if lower.endswith(".xlsx") or lower.endswith(".xls"):
-            extracted_docs.extend(extract_from_excel(data, blob_name))
-        elif lower.endswith(".pdf"):
-            extracted_docs.extend(extract_from_pdf(data, blob_name))
-
-    search_docs = []
-    for d in extracted_docs:
-        emb = get_embedding(d["content"])
-        search_docs.append({
-            "id": str(uuid.uuid4()),
-            "content": d["content"],
-            "source_type": d["source_type"],
-            "source_file": d["source_file"],
-            "page": int(d["page"]),
-            "contentVector": emb,
-            "ingested_at": datetime.utcnow().isoformat()
-        })
-
-    batch_size = 200
-    for i in range(0, len(search_docs), batch_size):
-        batch = search_docs[i:i + batch_size]
-        search_client.upload_documents(documents=batch)
-
-    return {"status": "success", "chunks_uploaded": len(search_docs)}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        for docs in ex.map(lambda name: _download_and_extract(container_client, name), blob_names):
+            extracted_docs.extend(docs)
+
+    embeddings = to_vector_field(get_embeddings([d["content"] for d in extracted_docs]))
+
+    ingested_at = datetime.utcnow().isoformat()
+    search_docs = [{
+        "id": doc_id,
+        "content": d["content"],
+        "source_type": d["source_type"],
+        "source_file": d["source_file"],
+        "page": int(d["page"]),
+        "contentVector": emb,
+        "ingested_at": ingested_at
+    } for d, emb, doc_id in zip(extracted_docs, embeddings, new_doc_ids(len(extracted_docs)))]
+
+    uploaded = upload_search_docs(search_docs)
+
+    return {"status": "success", "chunks_uploaded": uploaded}